@@ -28,8 +28,8 @@ def webhook():
     event = {
         "httpMethod": request.method,
         "headers": dict(request.headers),
-        "body": request.data.decode("utf-8"),
-        "queryStringParameters": dict(request.args) if request.args else {},
+        "body": request.get_data(),
+        "queryStringParameters": request.args.to_dict() if request.args else {},
         "queryString": request.query_string.decode("utf-8") if request.query_string else ""
     }
     
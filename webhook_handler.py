@@ -9,29 +9,269 @@ This module contains the core business logic for processing DrChrono webhooks:
 - Uploads matching PDFs to AWS S3
 
 All sensitive operations use environment variables for configuration.
+
+The HTTP, AWS and PDF libraries and the worker pool are set up on the
+first POST that needs them (PDFium only once a PDF has to be parsed), so
+GET verification requests on a cold start only import the standard
+library and, when installed, orjson.
 """
 
 import os
-import requests
-import boto3
+import base64
 import hmac
 import hashlib
-from PyPDF2 import PdfReader
-from io import BytesIO
+import itertools
+import re
+import types
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 import json
-from dotenv import load_dotenv
+import tempfile
+from urllib.parse import unquote_plus
+
+try:
+    import orjson
+except ImportError:  # stdlib json is used when the orjson wheel is unavailable
+    orjson = None
+
+# Load environment variables from .env file, unless the platform has
+# already injected them (as serverless deployments do)
+if "DRCHRONO_WEBHOOK_SECRET" not in os.environ:
+    from dotenv import load_dotenv
+    load_dotenv()
+
+if orjson is not None:
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        # Match orjson's compact output so responses don't depend on the backend
+        return json.dumps(obj, separators=(",", ":"))
+
+# Configuration resolved once per process rather than on every request
+_CFG = types.SimpleNamespace(
+    secret_bytes=(os.environ.get("DRCHRONO_WEBHOOK_SECRET") or "").encode(),
+    provider=os.environ.get("PROVIDER_STRING"),
+    bucket=os.environ.get("S3_BUCKET"),
+    s3_accelerate=os.environ.get("S3_ACCELERATE", "").lower() in ("1", "true", "yes"),
+    s3_speculative=os.environ.get("S3_SPECULATIVE_UPLOAD", "").lower() in ("1", "true", "yes"),
+    queue_url=os.environ.get("SQS_QUEUE_URL"),
+    key_prefix="chrono-webhook/note_",
+)
+
+# Current DrChrono access token and its expiry in epoch seconds (None when
+# unknown, as for the token from the environment); updated by refresh_token()
+_TOKEN_CACHE = {"access_token": os.environ.get("DRCHRONO_ACCESS_TOKEN"), "exp": None}
+
+# Seconds before expiry at which the access token is refreshed proactively
+_TOKEN_REFRESH_MARGIN = 60
+
+# Serializes token refreshes, so concurrent queue workers that all see an
+# expired token trigger one refresh between them
+_TOKEN_LOCK = threading.Lock()
+
+# Heavy dependencies and the shared HTTP session, set up by _load_heavy();
+# PDFium is only needed when the raw byte scan misses, see _load_pdfium()
+requests = None
+boto3 = None
+pdfium = None
+_SESSION = None
+_HEAVY_LOCK = threading.Lock()
+
+# PDFs are spooled in memory up to this size, then to disk
+_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+# S3 uploads above this size are split into parts of this size
+_MULTIPART_SIZE = 8 * 1024 * 1024
+
+# Parts of a multipart upload sent in parallel, each on its own pooled
+# connection, by upload_pdf() and the speculative upload alike; S3
+# throughput is capped per connection, not per upload
+_UPLOAD_CONCURRENCY = 8
+
+# Size of the S3 client's connection pool; concurrent uploads split it
+# between them rather than each using _UPLOAD_CONCURRENCY connections
+_S3_MAX_CONNECTIONS = 16
+
+# Read size for the raw-bytes provider scan
+_SCAN_CHUNK = 256 * 1024
+
+# Characters of first-page text extracted per window
+_TEXT_WINDOW = 4096
+
+# PDFium is not thread-safe, even across documents; every PDFium call, from
+# opening a document to closing it, runs with this lock held
+_PDFIUM_LOCK = threading.Lock()
+
+# Content types that mark a PDF response as an error page, the size at or
+# below which a response cannot be a PDF ("%PDF" alone is four bytes), and
+# how far into the file the "%PDF-" header may start
+_ERROR_PAGE_TYPES = ("text/", "application/json", "application/xml", "application/problem+")
+_MIN_PDF_SIZE = 4
+_PDF_HEADER_WINDOW = 1024
+
+# AWS clients, created on first use and reused across warm invocations
+_S3_CLIENT = None
+_SQS_CLIENT = None
+_AWS_LOCK = threading.Lock()
+
+# Records of an SQS batch processed concurrently by process_queue()
+_QUEUE_WORKERS = 8
+
+# Worker threads for background S3 work, created by _load_heavy() and
+# reused across warm invocations; one per pooled S3 connection, so the
+# speculative upload parts of a full queue batch don't wait on each other
+_EXECUTOR = None
+
+# Seconds to wait for a background upload before failing the request
+_UPLOAD_TIMEOUT = 25
+
+# Largest body accepted as an unsigned DrChrono verification event
+_MAX_UNSIGNED_BODY = 1024
+
+# Payload fields that may carry the clinical note ID, in priority order
+_NOTE_ID_KEYS = ("id", "clinical_note", "object_id")
+
+# Fixed responses, built once and returned as-is; callers only read them
+_RESP_MISSING_MSG = {"statusCode": 400, "body": "Missing msg parameter"}
+_RESP_NOT_POST = {"statusCode": 405, "body": "Only POST allowed"}
+_RESP_BAD_BODY = {"statusCode": 400, "body": '{"error":"Malformed base64 body"}'}
+_RESP_VERIFIED = {"statusCode": 200, "body": ""}
+_RESP_BAD_SIG = {"statusCode": 401, "body": '{"error":"Invalid signature"}'}
+_RESP_NO_NOTE_ID = {"statusCode": 400, "body": '{"error":"No note ID in webhook payload"}'}
+_RESP_QUEUED = {"statusCode": 200, "body": '{"status":"queued"}'}
+
+# process_note() results that carry nothing beyond their status
+_STATUS_RESPONSES = {
+    "no_pdf": {"statusCode": 200, "body": '{"status":"no_pdf"}'},
+    "provider_not_found": {"statusCode": 200, "body": '{"status":"provider_not_found"}'},
+}
+
+# Recently fetched notes, {note_id: (expiry_ts, note)}, and the S3 keys of
+# recently uploaded notes, {note_id: (expiry_ts, key)}; both expire after
+# _NOTE_CACHE_TTL seconds and absorb DrChrono's duplicate deliveries of the
+# same event without hiding later amendments to the note
+_NOTE_CACHE_TTL = 60
+_NOTE_CACHE = {}
+_UPLOADED_MAX = 1024
+_UPLOADED = OrderedDict()
+
+# Provider-check results keyed by (PDF SHA-256 digest, provider), so a
+# redelivered PDF with identical content is not parsed again
+_PDF_MATCHES_MAX = 512
+_PDF_MATCHES = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+def _load_heavy():
+    """
+    Import the HTTP and AWS libraries and create the shared session.
+    
+    Safe to call repeatedly; the work is done once per process. The session
+    reuses pooled keep-alive connections for all calls to DrChrono, and
+    retries GETs that hit transient 429/5xx responses with a short,
+    bounded exponential backoff so they don't fail the webhook and
+    trigger a full redelivery.
+    
+    The background worker pool is started here too, so concurrent.futures
+    stays off the GET verification path.
+    """
+    global requests, boto3, _SESSION, _EXECUTOR
+    if _SESSION is not None:
+        return
+    with _HEAVY_LOCK:
+        if _SESSION is not None:
+            return
+        import requests as _requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        import boto3 as _boto3
+        from concurrent.futures import ThreadPoolExecutor
+
+        session = _requests.Session()
+        session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=16,
+                # Backoff sleeps add up to about 4 s; Retry-After is
+                # ignored so a long value can't outlast DrChrono's delivery
+                # timeout. Only GETs are retried, so a 5xx from the token
+                # endpoint never resends the refresh-token grant.
+                max_retries=Retry(
+                    total=4,
+                    backoff_factor=0.3,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(["GET"]),
+                    respect_retry_after_header=False,
+                ),
+            ),
+        )
+        requests, boto3 = _requests, _boto3
+        _EXECUTOR = ThreadPoolExecutor(max_workers=_S3_MAX_CONNECTIONS)
+        _SESSION = session
 
-# Load environment variables from .env file
-load_dotenv()
+def _load_pdfium():
+    """
+    Import pypdfium2 on first use.
+    
+    Kept apart from _load_heavy() because most PDFs are settled by the raw
+    byte scan, and queue-mode webhooks never touch a PDF at all.
+    """
+    global pdfium
+    if pdfium is None:
+        with _HEAVY_LOCK:
+            if pdfium is None:
+                import pypdfium2 as _pdfium
+                pdfium = _pdfium
+
+def _get_session():
+    """
+    Return the shared requests session, loading dependencies on first use.
+    
+    Returns:
+        requests.Session: Pooled HTTP session
+    """
+    _load_heavy()
+    return _SESSION
+
+@lru_cache(maxsize=4)
+def _keyed_hmac(secret):
+    """
+    Build an HMAC-SHA256 object already keyed with the webhook secret.
+    
+    Keying pads the secret and hashes the inner/outer blocks; doing it once
+    and copying the keyed object per message skips that work per request.
+    
+    Args:
+        secret: Webhook secret bytes
+        
+    Returns:
+        hmac.HMAC: Keyed HMAC object; callers must copy() before updating
+    """
+    return hmac.new(secret, digestmod=hashlib.sha256)
+
+# Key the configured secret's HMAC at import
+if _CFG.secret_bytes:
+    _keyed_hmac(_CFG.secret_bytes)
 
 def verify_signature(headers, body, secret):
     """
     Verify the HMAC signature of a DrChrono webhook request.
     
+    The hex signature header is decoded once and compared against the raw
+    32-byte digest; a malformed header is treated as a mismatch.
+    
     Args:
         headers: Dictionary of request headers
         body: Raw request body bytes
-        secret: Webhook secret from environment variables
+        secret: Webhook secret from environment variables (str or bytes)
         
     Returns:
         bool: True if signature is valid, False otherwise
@@ -39,15 +279,24 @@ def verify_signature(headers, body, secret):
     signature = headers.get("X-Drchrono-Signature")
     if not signature or not secret:
         return False
-    computed = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
-    return hmac.compare_digest(computed, signature)
+    try:
+        expected = bytes.fromhex(signature)
+    except ValueError:
+        return False
+    if isinstance(secret, str):
+        secret = secret.encode()
+    mac = _keyed_hmac(secret).copy()
+    mac.update(body)
+    computed = mac.digest()
+    return hmac.compare_digest(computed, expected)
 
 def refresh_token():
     """
     Refresh the DrChrono OAuth access token using the refresh token.
     
     Makes a POST request to DrChrono's token endpoint to get a new access token.
-    Updates the environment variable with the new token.
+    Stores the new token and its expiry in the module-level token cache, so
+    warm invocations reuse it and refresh shortly before it expires.
     
     Returns:
         str: New access token
@@ -55,7 +304,7 @@ def refresh_token():
     Raises:
         requests.exceptions.HTTPError: If the token refresh fails
     """
-    resp = requests.post(
+    resp = _get_session().post(
         "https://drchrono.com/o/token/",
         data={
             "grant_type": "refresh_token",
@@ -66,17 +315,87 @@ def refresh_token():
         timeout=30,
     )
     resp.raise_for_status()
-    new_token = resp.json()["access_token"]
-    os.environ["DRCHRONO_ACCESS_TOKEN"] = new_token
-    return new_token
+    payload = resp.json()
+    expires_in = payload.get("expires_in")
+    _TOKEN_CACHE["access_token"] = payload["access_token"]
+    _TOKEN_CACHE["exp"] = time.time() + expires_in if expires_in else None
+    return payload["access_token"]
+
+def _access_token():
+    """
+    Return the cached access token, refreshing it first if needed.
+    
+    A refresh happens when there is no token or when a known expiry is less
+    than _TOKEN_REFRESH_MARGIN seconds away, saving a round-trip to a 401.
+    
+    Returns:
+        str: DrChrono OAuth access token
+    """
+    token = _TOKEN_CACHE["access_token"]
+    exp = _TOKEN_CACHE["exp"]
+    if not token or (exp is not None and time.time() > exp - _TOKEN_REFRESH_MARGIN):
+        return _refresh_token_once(token)
+    return token
+
+def _refresh_token_once(stale):
+    """
+    Refresh the access token unless another thread already replaced it.
+    
+    Args:
+        stale: Token the caller found expired or had rejected
+        
+    Returns:
+        str: DrChrono OAuth access token
+    """
+    with _TOKEN_LOCK:
+        token = _TOKEN_CACHE["access_token"]
+        if token and token != stale:
+            return token
+        return refresh_token()
+
+class _BearerAuth:
+    """
+    Bearer-token auth for DrChrono API requests, refreshing once on a 401.
+    
+    requests accepts any callable taking a PreparedRequest as auth, so this
+    doesn't subclass requests.auth.AuthBase, which would make requests an
+    import-time dependency again.
+    """
+
+    def __init__(self, token=None):
+        self.token = token
+
+    def __call__(self, request):
+        request.headers["Authorization"] = f"Bearer {self.token or _access_token()}"
+        request.register_hook("response", self._refresh_on_401)
+        return request
+
+    def _refresh_on_401(self, resp, **kwargs):
+        """Response hook: refresh the token and resend the request once."""
+        if resp.status_code != 401 or getattr(resp.request, "token_refreshed", False):
+            return resp
+        self.token = _refresh_token_once(resp.request.headers["Authorization"][len("Bearer "):])
+        # Release the connection before resending
+        resp.content
+        resp.close()
+        retry = resp.request.copy()
+        retry.headers["Authorization"] = f"Bearer {self.token}"
+        retry.token_refreshed = True
+        new_resp = resp.connection.send(retry, **kwargs)
+        new_resp.history.append(resp)
+        new_resp.request = retry
+        return new_resp
 
-def fetch_note(note_id, token):
+def fetch_note(note_id, token=None):
     """
     Fetch clinical note details from DrChrono API.
     
+    Responses are cached for _NOTE_CACHE_TTL seconds so redelivered
+    webhooks for the same note don't repeat the API call.
+    
     Args:
         note_id: ID of the clinical note to fetch
-        token: DrChrono OAuth access token
+        token: DrChrono OAuth access token; defaults to the cached token
         
     Returns:
         dict: Clinical note details in JSON format
@@ -84,57 +403,674 @@ def fetch_note(note_id, token):
     Raises:
         requests.exceptions.HTTPError: If the API request fails
     """
+    now = time.time()
+    with _CACHE_LOCK:
+        cached = _NOTE_CACHE.get(note_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
     url = f"https://drchrono.com/api/clinical_notes/{note_id}"
-    headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(url, headers=headers, timeout=30)
+    # The auth refreshes the token and retries once if it has expired
+    resp = _get_session().get(url, auth=_BearerAuth(token), timeout=30)
+    resp.raise_for_status()
+    note = resp.json()
+    with _CACHE_LOCK:
+        # Drop expired entries so the cache stays bounded
+        for key in [k for k, (exp, _) in _NOTE_CACHE.items() if exp <= now]:
+            del _NOTE_CACHE[key]
+        _NOTE_CACHE[note_id] = (now + _NOTE_CACHE_TTL, note)
+    return note
+
+@lru_cache(maxsize=8)
+def _provider_patterns(provider):
+    """
+    Compile the whitespace-tolerant matchers for a provider name.
     
-    # Handle token expiration by refreshing and retrying
-    if resp.status_code == 401:
-        token = refresh_token()
-        headers = {"Authorization": f"Bearer {token}"}
-        resp = requests.get(url, headers=headers, timeout=30)
+    Raw PDF strings are matched in UTF-8 and in cp1252, which is close to
+    the WinAnsiEncoding most simple fonts use. The exact encoded name is
+    tried with a plain bytes search first. The bytes pattern lets the words
+    run together, since raw content streams often position words instead
+    of emitting spaces. The text pattern needs at least one whitespace
+    character between words.
     
-    resp.raise_for_status()
-    return resp.json()
+    Args:
+        provider: Provider name string
+        
+    Returns:
+        types.SimpleNamespace: literals (tuple of encoded names), raw (bytes
+        re.Pattern for raw PDF data) and text (str re.Pattern for extracted text)
+    """
+    words = provider.split()
+    literals = []
+    raw = []
+    for encoding in ("utf-8", "cp1252"):
+        try:
+            encoded = [w.encode(encoding) for w in words]
+        except UnicodeEncodeError:
+            continue
+        literal = b" ".join(encoded)
+        if literal not in literals:
+            literals.append(literal)
+            raw.append(rb"\s*".join(map(re.escape, encoded)))
+    return types.SimpleNamespace(
+        literals=tuple(literals),
+        raw=re.compile(b"|".join(raw)),
+        text=re.compile(r"\s+".join(re.escape(w) for w in words)),
+    )
+
+# Compile the configured provider's matchers at import
+if _CFG.provider:
+    _provider_patterns(_CFG.provider)
+
+def _provider_in_chunks(chunks, provider):
+    """
+    Scan raw PDF bytes for a provider's name without parsing the PDF.
+    
+    Only the bytes as stored are searched, so this catches literal text in
+    uncompressed content streams; compressed streams are not inflated and
+    are left to PDFium's first-page extraction. The match is not limited
+    to the first page. A tail of each chunk is carried into the next so a
+    match split across a chunk boundary is still found. Stops consuming
+    chunks on a match.
+    
+    Args:
+        chunks: Iterable of bytes chunks
+        provider: Provider name string to search for
+        
+    Returns:
+        bool: True if the name appears anywhere in the raw bytes
+    """
+    patterns = _provider_patterns(provider)
+    overlap = 4 * len(provider.encode())
+    tail = b""
+    for chunk in chunks:
+        buf = tail + chunk
+        if any(literal in buf for literal in patterns.literals) or patterns.raw.search(buf):
+            return True
+        tail = buf[-overlap:]
+    return False
+
+def _provider_in_raw_pdf(pdf_file, provider):
+    """
+    Scan a PDF file's raw bytes for a provider's name.
+    
+    Args:
+        pdf_file: Seekable binary file object containing the PDF
+        provider: Provider name string to search for
+        
+    Returns:
+        bool: True if the name appears anywhere in the raw bytes
+    """
+    pdf_file.seek(0)
+    return _provider_in_chunks(iter(lambda: pdf_file.read(_SCAN_CHUNK), b""), provider)
+
+def _write_chunks(resp, pdf_file, digest):
+    """
+    Copy a streamed response into a file, yielding each chunk as written.
+    
+    Each chunk is also fed to the running content hash.
+    """
+    for chunk in resp.iter_content(chunk_size=64 * 1024):
+        pdf_file.write(chunk)
+        digest.update(chunk)
+        yield chunk
 
-def provider_in_pdf(pdf_bytes, provider):
+def _looks_like_pdf(headers):
+    """
+    Check a PDF response's headers before its body is read.
+    
+    Only responses that are clearly not a PDF are rejected: error-page
+    types such as HTML or JSON, or a Content-Length too small to hold one.
+    A missing or unusual Content-Type (application/x-pdf, generic binary)
+    is left to the "%PDF-" check on the first chunk, and a missing
+    Content-Length (chunked transfer) is not treated as empty.
+    """
+    content_type = headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    if content_type.startswith(_ERROR_PAGE_TYPES):
+        return False
+    try:
+        return int(headers.get("content-length", _MIN_PDF_SIZE + 1)) > _MIN_PDF_SIZE
+    except ValueError:
+        return True
+
+def download_pdf(pdf_url, provider=None):
+    """
+    Stream a PDF from DrChrono into a spooled temporary file.
+    
+    The response is read in chunks so that large PDFs never have to be
+    held in memory as a single bytes object. When a provider is given,
+    the raw byte scan runs on each chunk as it arrives, overlapping the
+    check with the download instead of re-reading the file afterwards.
+    
+    The response headers are checked before any of the body is read, so
+    an error page served in place of the PDF is dropped without being
+    downloaded; a body whose first chunk lacks the "%PDF-" header is
+    dropped after that chunk.
+    
+    Args:
+        pdf_url: URL of the clinical note PDF
+        provider: Optional provider name string to scan for while downloading
+        
+    Returns:
+        tuple: (SpooledTemporaryFile positioned at the start,
+                bool True if the raw scan found the provider,
+                bytes SHA-256 digest of the PDF),
+               or None if the response is not a PDF
+        
+    Raises:
+        requests.exceptions.HTTPError: If the download fails
+    """
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    digest = hashlib.sha256()
+    found = False
+    try:
+        with _get_session().get(pdf_url, stream=True, timeout=30) as resp:
+            resp.raise_for_status()
+            if not _looks_like_pdf(resp.headers):
+                pdf_file.close()
+                return None
+            chunks = _write_chunks(resp, pdf_file, digest)
+            first = next(chunks, b"")
+            if b"%PDF-" not in first[:_PDF_HEADER_WINDOW]:
+                pdf_file.close()
+                return None
+            chunks = itertools.chain((first,), chunks)
+            if provider:
+                found = _provider_in_chunks(chunks, provider)
+            # Finish the download; the whole file is needed for the upload
+            for _ in chunks:
+                pass
+    except Exception:
+        pdf_file.close()
+        raise
+    pdf_file.seek(0)
+    return pdf_file, found, digest.digest()
+
+def provider_in_pdf(pdf_file, provider, scan_raw=True):
     """
     Check if a provider's name appears in the first page of a PDF.
     
+    A raw byte scan runs first and returns early on a plain-text hit. That
+    scan covers the uncompressed bytes of the whole file, so a hit there
+    may come from a later page; only if it misses is the first page
+    parsed and its text extracted.
+    
     Args:
-        pdf_bytes: Raw PDF content as bytes
+        pdf_file: Seekable binary file object containing the PDF
         provider: Provider name string to search for
+        scan_raw: Set False when the raw scan already ran (e.g. during download)
         
     Returns:
         bool: True if provider name found in PDF, False otherwise
     """
-    reader = PdfReader(BytesIO(pdf_bytes))
-    if not reader.pages:
-        return False
+    if scan_raw and _provider_in_raw_pdf(pdf_file, provider):
+        return True
+
+    # Extract text from first page window by window, stopping at a match;
+    # a tail of each window is carried over to catch names split between them
+    pattern = _provider_patterns(provider).text
+    overlap = 4 * len(provider)
+    tail = ""
+    windows = _first_page_text_windows(pdf_file)
+    try:
+        for window in windows:
+            text = tail + window
+            if pattern.search(text):
+                return True
+            tail = text[-overlap:]
+    finally:
+        windows.close()
+    return False
+
+def _first_page_text_windows(pdf_file):
+    """
+    Extract the text of a PDF's first page with PDFium, in windows.
+    
+    PDFium loads objects on demand, so only the first page gets parsed.
+    Every PDFium handle is closed when the generator finishes or is closed,
+    so native memory is released promptly in long-lived workers. The
+    generator holds _PDFIUM_LOCK from opening the document until it is
+    closed, so callers must exhaust or close it promptly.
+    
+    Args:
+        pdf_file: Seekable binary file object containing the PDF
+        
+    Yields:
+        str: Consecutive slices of up to _TEXT_WINDOW characters
+    """
+    _load_pdfium()
+    pdf_file.seek(0)
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_file)
+        try:
+            if len(pdf) == 0:
+                return
+            page = pdf[0]
+            try:
+                textpage = page.get_textpage()
+                try:
+                    count = textpage.count_chars()
+                    for index in range(0, count, _TEXT_WINDOW):
+                        yield textpage.get_text_range(index, min(_TEXT_WINDOW, count - index))
+                finally:
+                    textpage.close()
+            finally:
+                page.close()
+        finally:
+            pdf.close()
+
+def _aws_client_kwargs():
+    """
+    Build the region and credential arguments shared by the AWS clients.
+    
+    Explicit MY_AWS_* keys are used when present; otherwise boto3's default
+    credential chain applies, e.g. the execution role on AWS Lambda.
+    Defaults to us-east-1 region if not specified.
+    
+    Returns:
+        dict: Keyword arguments for boto3.client()
+    """
+    kwargs = {"region_name": os.environ.get("MY_AWS_REGION", "us-east-1")}
+    if os.environ.get("MY_AWS_ACCESS_KEY_ID"):
+        kwargs["aws_access_key_id"] = os.environ["MY_AWS_ACCESS_KEY_ID"]
+        kwargs["aws_secret_access_key"] = os.environ["MY_AWS_SECRET_ACCESS_KEY"]
+    return kwargs
+
+def _get_sqs():
+    """
+    Return the shared boto3 SQS client, creating it on first use.
+    
+    Returns:
+        botocore.client.SQS: Cached SQS client
+    """
+    global _SQS_CLIENT
+    if _SQS_CLIENT is not None:
+        return _SQS_CLIENT
+    _load_heavy()
+    with _AWS_LOCK:
+        if _SQS_CLIENT is None:
+            _SQS_CLIENT = boto3.client("sqs", **_aws_client_kwargs())
+    return _SQS_CLIENT
+
+def _get_s3():
+    """
+    Return the shared boto3 S3 client, creating it on first use.
+    
+    Client construction loads botocore service data and credentials, so it
+    is done once per process rather than once per upload. Connections are
+    kept alive between uploads, and the S3 Transfer Acceleration endpoint
+    is used when S3_ACCELERATE is set (acceleration must be enabled on the
+    bucket).
+    
+    Credentials and region come from _aws_client_kwargs().
+    Creation is lock-guarded so the background warm-up started by
+    process_webhook and a caller on the request thread can't race.
+    
+    Returns:
+        botocore.client.S3: Cached S3 client
+    """
+    global _S3_CLIENT
+    if _S3_CLIENT is not None:
+        return _S3_CLIENT
+    _load_heavy()
+    with _AWS_LOCK:
+        if _S3_CLIENT is None:
+            from botocore.config import Config
+            _S3_CLIENT = boto3.client(
+                "s3",
+                **_aws_client_kwargs(),
+                config=Config(
+                    s3={
+                        "use_accelerate_endpoint": _CFG.s3_accelerate,
+                        "addressing_style": "virtual",
+                    },
+                    tcp_keepalive=True,
+                    max_pool_connections=_S3_MAX_CONNECTIONS,
+                    retries={"max_attempts": 5, "mode": "adaptive"},
+                ),
+            )
+    return _S3_CLIENT
+
+def _cached_match(digest, provider):
+    """
+    Look up a previous provider-check result for identical PDF content.
+    
+    Args:
+        digest: SHA-256 digest of the PDF bytes
+        provider: Provider name string that was searched for
+        
+    Returns:
+        bool or None: Cached result, or None if this content wasn't checked
+    """
+    with _CACHE_LOCK:
+        return _PDF_MATCHES.get((digest, provider))
+
+def _remember_match(digest, provider, matched):
+    """
+    Cache a provider-check result, evicting the oldest beyond _PDF_MATCHES_MAX.
     
-    # Extract text from first page and check for provider name
-    text = reader.pages[0].extract_text() or ""
-    return provider in text
+    Args:
+        digest: SHA-256 digest of the PDF bytes
+        provider: Provider name string that was searched for
+        matched: Result of the provider check
+    """
+    with _CACHE_LOCK:
+        _PDF_MATCHES[(digest, provider)] = matched
+        _PDF_MATCHES.move_to_end((digest, provider))
+        while len(_PDF_MATCHES) > _PDF_MATCHES_MAX:
+            _PDF_MATCHES.popitem(last=False)
 
-def upload_pdf(pdf_bytes, bucket, key):
+def _uploaded_key(note_id):
+    """
+    Look up the S3 key this process uploaded for a note, if still fresh.
+    
+    Entries expire _NOTE_CACHE_TTL seconds after the upload.
+    
+    Args:
+        note_id: ID of the clinical note
+        
+    Returns:
+        str or None: S3 object key, or None if the note wasn't uploaded recently
+    """
+    with _CACHE_LOCK:
+        cached = _UPLOADED.get(note_id)
+        if cached is None:
+            return None
+        if cached[0] <= time.time():
+            del _UPLOADED[note_id]
+            return None
+        return cached[1]
+
+def _remember_upload(note_id, key):
+    """
+    Record a note's uploaded S3 key, evicting the oldest beyond _UPLOADED_MAX.
+    
+    Args:
+        note_id: ID of the clinical note
+        key: S3 object key/path
+    """
+    with _CACHE_LOCK:
+        _UPLOADED[note_id] = (time.time() + _NOTE_CACHE_TTL, key)
+        _UPLOADED.move_to_end(note_id)
+        while len(_UPLOADED) > _UPLOADED_MAX:
+            _UPLOADED.popitem(last=False)
+
+def _precondition_failed(exc):
+    """
+    Check whether an S3 error is a 412 from an If-None-Match: * write.
+    """
+    return exc.response.get("Error", {}).get("Code") == "PreconditionFailed"
+
+def upload_pdf(pdf_file, bucket, key, digest=None, concurrency=_UPLOAD_CONCURRENCY):
     """
     Upload a PDF file to AWS S3.
     
+    Files up to _MULTIPART_SIZE go up in a single PUT sent with
+    If-None-Match: *, so a key that already exists is answered with a 412
+    instead of being overwritten. Keys are content-addressed by
+    process_note(), so an existing key already holds the same bytes and
+    the 412 counts as success. Larger files use boto3's managed multipart
+    transfer, sending up to concurrency parts at once, with failed
+    multipart uploads aborted; the transfer manager does not accept
+    If-None-Match, so those are always written.
+    
+    S3 verifies a SHA-256 checksum of the upload in both cases. Uses the
+    shared client from _get_s3(), configured from environment variables.
+    
     Args:
-        pdf_bytes: Raw PDF content as bytes
+        pdf_file: Seekable binary file object containing the PDF
         bucket: Name of the S3 bucket
         key: S3 object key/path for the PDF
+        digest: Optional SHA-256 digest of the PDF, sent instead of having
+                the checksum computed again
+        concurrency: Most multipart parts to send at once
         
-    Uses AWS credentials from environment variables.
-    Defaults to us-east-1 region if not specified.
+    Returns:
+        bool: True if the object was written, False if the key already existed
+    """
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+    s3 = _get_s3()
+    pdf_file.seek(0, os.SEEK_END)
+    size = pdf_file.tell()
+    pdf_file.seek(0)
+    if size <= _MULTIPART_SIZE:
+        checksum = {"ChecksumAlgorithm": "SHA256"}
+        if digest is not None:
+            checksum["ChecksumSHA256"] = base64.b64encode(digest).decode("ascii")
+        try:
+            s3.put_object(Bucket=bucket, Key=key, Body=pdf_file, IfNoneMatch="*", **checksum)
+        except ClientError as e:
+            if _precondition_failed(e):
+                return False
+            raise
+        return True
+
+    s3.upload_fileobj(
+        pdf_file, bucket, key,
+        ExtraArgs={"ChecksumAlgorithm": "SHA256"},
+        Config=TransferConfig(
+            multipart_threshold=_MULTIPART_SIZE,
+            multipart_chunksize=_MULTIPART_SIZE,
+            max_concurrency=concurrency,
+            use_threads=True,
+        ),
+    )
+    return True
+
+def _start_speculative_upload(pdf_file, bucket, key, concurrency=_UPLOAD_CONCURRENCY):
+    """
+    Start uploading a PDF as an uncompleted multipart upload.
+    
+    Parts are sent from up to concurrency worker threads, as for
+    upload_pdf(), while the caller is still checking the PDF. No object
+    becomes visible until the upload is completed by
+    _finish_speculative_upload(), which aborts it instead if the check fails.
+    
+    The spool is moved to disk so parts can be read with os.pread, which
+    leaves the file position used by the caller untouched. The workers
+    check a cancel event before each part; the spool must stay open until
+    _finish_speculative_upload() returns, since that is when the workers
+    are known to have exited.
+    
+    Args:
+        pdf_file: SpooledTemporaryFile containing the fully written PDF
+        bucket: Name of the S3 bucket
+        key: S3 object key/path for the PDF
+        concurrency: Most parts to send at once
+        
+    Returns:
+        types.SimpleNamespace: Upload state for _finish_speculative_upload()
     """
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=os.environ["MY_AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=os.environ["MY_AWS_SECRET_ACCESS_KEY"],
-        region_name=os.environ.get("MY_AWS_REGION", "us-east-1"),
+    s3 = _get_s3()
+    fd = pdf_file.fileno()
+    part_count = max(1, -(-os.fstat(fd).st_size // _MULTIPART_SIZE))
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    cancel = threading.Event()
+    lock = threading.Lock()
+    part_numbers = iter(range(1, part_count + 1))
+    parts = []
+
+    def upload_parts():
+        while not cancel.is_set():
+            with lock:
+                part_number = next(part_numbers, None)
+            if part_number is None:
+                return
+            part = os.pread(fd, _MULTIPART_SIZE, (part_number - 1) * _MULTIPART_SIZE)
+            resp = s3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                PartNumber=part_number, Body=part,
+            )
+            with lock:
+                parts.append({"ETag": resp["ETag"], "PartNumber": part_number})
+
+    workers = [_EXECUTOR.submit(upload_parts) for _ in range(min(concurrency, part_count))]
+    return types.SimpleNamespace(
+        bucket=bucket, key=key, upload_id=upload_id, cancel=cancel,
+        parts=parts, workers=workers,
     )
-    s3.put_object(Bucket=bucket, Key=key, Body=pdf_bytes)
+
+def _finish_speculative_upload(upload, keep):
+    """
+    Complete or abort an upload started by _start_speculative_upload().
+    
+    The upload is completed with If-None-Match: *, and a 412 for a key
+    that already exists is treated as success. When the upload is not
+    kept, or its parts don't finish within _UPLOAD_TIMEOUT, the workers
+    are cancelled and the upload aborted; parts not yet started are never
+    sent. Either way this returns only after the workers have exited, so
+    the caller can close the spool they read from.
+    
+    Args:
+        upload: State returned by _start_speculative_upload()
+        keep: True to complete the upload, False to abort it
+        
+    Raises:
+        Exception: If keep is True and the upload cannot be completed
+    """
+    from botocore.exceptions import ClientError
+    s3 = _get_s3()
+    completed = False
+    try:
+        if not keep:
+            return
+        deadline = time.time() + _UPLOAD_TIMEOUT
+        for worker in upload.workers:
+            worker.result(timeout=max(0, deadline - time.time()))
+        s3.complete_multipart_upload(
+            Bucket=upload.bucket, Key=upload.key, UploadId=upload.upload_id,
+            MultipartUpload={"Parts": sorted(upload.parts, key=lambda p: p["PartNumber"])},
+            IfNoneMatch="*",
+        )
+        completed = True
+    except ClientError as e:
+        # A 412 means identical content is already stored under the key
+        if keep and not _precondition_failed(e):
+            raise
+    except Exception:
+        # Failures only matter for an upload that is being kept
+        if keep:
+            raise
+    finally:
+        if not completed:
+            # Let the workers finish the parts in flight and stop, then
+            # abort; aborting first could leave those parts behind in S3
+            upload.cancel.set()
+            for worker in upload.workers:
+                try:
+                    worker.result()
+                except Exception:
+                    pass
+            s3.abort_multipart_upload(
+                Bucket=upload.bucket, Key=upload.key, UploadId=upload.upload_id,
+            )
+
+def process_note(note_id, upload_concurrency=_UPLOAD_CONCURRENCY):
+    """
+    Fetch a clinical note's PDF and upload it to S3 if it names the provider.
+    
+    Args:
+        note_id: ID of the clinical note
+        upload_concurrency: Most multipart parts to send at once for this note
+        
+    Returns:
+        dict: Outcome with a "status" of uploaded, uploaded_cached, no_pdf
+              or provider_not_found, plus "s3_key" when uploaded
+        
+    Raises:
+        Exception: If a DrChrono, PDF or S3 operation fails
+    """
+    note_id = str(note_id)
+    s3_key = _uploaded_key(note_id)
+    if s3_key is not None:
+        return {"status": "uploaded_cached", "s3_key": s3_key}
+
+    note = fetch_note(note_id)
+    pdf_url = note.get("pdf")
+    if not pdf_url:
+        return {"status": "no_pdf"}
+
+    downloaded = download_pdf(pdf_url, _CFG.provider)
+    if downloaded is None:
+        return {"status": "no_pdf"}
+    pdf_file, raw_match, digest = downloaded
+    # Content-addressed key: a re-delivered note maps to the same object,
+    # an amended note (once its cache entries expire) to a new one
+    s3_key = _CFG.key_prefix + note_id + "_" + digest.hex()[:16] + ".pdf"
+    with pdf_file:
+        matched = raw_match or _cached_match(digest, _CFG.provider)
+        speculative = None
+        if matched is None:
+            if _CFG.s3_speculative:
+                # Send the PDF to S3 while PDFium checks the first page
+                speculative = _start_speculative_upload(
+                    pdf_file, _CFG.bucket, s3_key, upload_concurrency,
+                )
+            try:
+                matched = provider_in_pdf(pdf_file, _CFG.provider, scan_raw=False)
+            except Exception:
+                if speculative is not None:
+                    _finish_speculative_upload(speculative, keep=False)
+                raise
+            _remember_match(digest, _CFG.provider, matched)
+
+        if speculative is not None:
+            _finish_speculative_upload(speculative, keep=matched)
+            if matched:
+                _remember_upload(note_id, s3_key)
+                return {"status": "uploaded", "s3_key": s3_key}
+            return {"status": "provider_not_found"}
+
+        if matched:
+            upload_pdf(pdf_file, _CFG.bucket, s3_key, digest, upload_concurrency)
+            _remember_upload(note_id, s3_key)
+            return {"status": "uploaded", "s3_key": s3_key}
+        else:
+            return {"status": "provider_not_found"}
+
+def _query_param(query_string, name):
+    """
+    Extract one parameter from a raw query string.
+    
+    Finds the first "name=" pair and decodes just that value, instead of
+    decoding every pair into a dict as parse_qs does.
+    
+    Args:
+        query_string: Raw query string (str, or bytes which are decoded)
+        name: Parameter name
+        
+    Returns:
+        str or None: Decoded value, or None if the parameter is absent
+    """
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode("latin-1")
+    prefix = name + "="
+    start = 0
+    while True:
+        i = query_string.find(prefix, start)
+        if i < 0:
+            return None
+        if i == 0 or query_string[i - 1] == "&":
+            end = query_string.find("&", i)
+            value = query_string[i + len(prefix):end if end >= 0 else None]
+            return unquote_plus(value)
+        start = i + 1
+
+def _parse_payload(body):
+    """
+    Parse a webhook body, treating malformed JSON as an empty payload.
+    
+    Args:
+        body: Raw request body bytes
+        
+    Returns:
+        dict: Parsed payload, or an empty dict if it cannot be parsed
+    """
+    try:
+        return _json_loads(body or b"{}")
+    except Exception:
+        return {}
 
 def process_webhook(event):
     """
@@ -148,76 +1084,133 @@ def process_webhook(event):
         event: Dictionary containing request details:
             - httpMethod: GET or POST
             - headers: Request headers
-            - body: Request body
-            - queryStringParameters: URL query parameters
+            - body: Raw request body (bytes, or str which is UTF-8 encoded)
+            - isBase64Encoded: True if body is base64 (API Gateway binary mode)
+            - queryStringParameters: URL query parameters (single string values)
+            - queryString: Raw query string, used if the parameters are absent
             
     Returns:
         dict: Response containing statusCode and body
     """
     method = event.get("httpMethod", "GET")
     headers = event.get("headers", {})
-    body = event.get("body", "").encode()
-    secret = os.environ.get("DRCHRONO_WEBHOOK_SECRET")
-    provider = os.environ.get("PROVIDER_STRING")
-    bucket = os.environ.get("S3_BUCKET")
 
     # --- DrChrono webhook verification via GET with msg param ---
     if method == "GET":
         # DrChrono sends a GET with a 'msg' parameter for verification
         msg = None
-        if "queryStringParameters" in event and event["queryStringParameters"]:
+        if event.get("queryStringParameters"):
             msg = event["queryStringParameters"].get("msg")
-            if isinstance(msg, list):
-                msg = msg[0]
-        elif "queryString" in event and event["queryString"]:
-            from urllib.parse import parse_qs
-            parsed = parse_qs(event["queryString"])
-            msg = parsed.get("msg", [None])[0]
-
-        if msg and secret:
-            hashed = hmac.new(secret.encode(), msg.encode(), hashlib.sha256).hexdigest()
-            return {"statusCode": 200, "body": json.dumps({"secret_token": hashed})}
+        elif event.get("queryString"):
+            msg = _query_param(event["queryString"], "msg")
+
+        if msg and _CFG.secret_bytes:
+            # One-shot C HMAC; the hex token needs no JSON escaping
+            hashed = hmac.digest(_CFG.secret_bytes, msg.encode(), "sha256").hex()
+            return {"statusCode": 200, "body": '{"secret_token":"' + hashed + '"}'}
         else:
-            return {"statusCode": 400, "body": "Missing msg parameter"}
+            return _RESP_MISSING_MSG
 
 
     if method != "POST":
-        return {"statusCode": 405, "body": "Only POST allowed"}
+        return _RESP_NOT_POST
 
-    try:
-        data = json.loads(event.get("body", "{}"))
-    except Exception:
-        data = {}
+    # Keep the body as bytes for both the HMAC check and JSON parsing;
+    # gateways in binary mode deliver it base64-encoded
+    body = event.get("body") or b""
+    if event.get("isBase64Encoded"):
+        try:
+            body = base64.b64decode(body)
+        except ValueError:  # binascii.Error
+            return _RESP_BAD_BODY
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
 
-    # Allow DrChrono verification event (no signature, just receiver key)
-    if "receiver" in data:
-        return {"statusCode": 200, "body": ""}  # Empty body for verification
+    # Allow DrChrono verification event (no signature, just receiver key).
+    # Only small bodies that look like one are parsed before the signature
+    # check, so unauthenticated callers can't make us parse large payloads.
+    data = None
+    if len(body) <= _MAX_UNSIGNED_BODY and b'"receiver"' in body:
+        data = _parse_payload(body)
+        if "receiver" in data:
+            return _RESP_VERIFIED  # Empty body for verification
 
-    if not verify_signature(headers, body, secret):
-        return {"statusCode": 401, "body": json.dumps({"error": "Invalid signature"})}
+    # Reject unsigned or forged requests before parsing the payload
+    if not verify_signature(headers, body, _CFG.secret_bytes):
+        return _RESP_BAD_SIG
 
-    note_id = data.get("id") or data.get("clinical_note") or data.get("object_id")
+    if data is None:
+        data = _parse_payload(body)
+
+    note_id = next(filter(None, map(data.get, _NOTE_ID_KEYS)), None)
     if not note_id:
-        return {"statusCode": 400, "body": json.dumps({"error": "No note ID in webhook payload"})}
+        return _RESP_NO_NOTE_ID
 
-    try:
-        token = os.environ.get("DRCHRONO_ACCESS_TOKEN")
-        note = fetch_note(note_id, token)
-        pdf_url = note.get("pdf")
-        if not pdf_url:
-            return {"statusCode": 200, "body": json.dumps({"status": "no_pdf"})}
-
-        resp = requests.get(pdf_url, timeout=30)
-        resp.raise_for_status()
-        pdf_bytes = resp.content
-
-        if provider_in_pdf(pdf_bytes, provider):
-            s3_key = f"chrono-webhook/note_{note_id}.pdf"
-            upload_pdf(pdf_bytes, bucket, s3_key)
-            return {"statusCode": 200, "body": json.dumps({"status": "uploaded", "s3_key": s3_key})}
-        else:
-            return {"statusCode": 200, "body": json.dumps({"status": "provider_not_found"})}
+    if _CFG.queue_url:
+        # Hand the note to the queue consumer and acknowledge right away
+        try:
+            _get_sqs().send_message(
+                QueueUrl=_CFG.queue_url,
+                MessageBody=_json_dumps({"note_id": note_id}),
+            )
+        except Exception as e:
+            print(f"Error: {e}")
+            return {"statusCode": 500, "body": _json_dumps({"error": str(e)})}
+        return _RESP_QUEUED
+
+    _load_heavy()
+    if _S3_CLIENT is None:
+        # Build the S3 client in the background while DrChrono is called
+        _EXECUTOR.submit(_get_s3)
 
+    try:
+        result = process_note(note_id)
     except Exception as e:
         print(f"Error: {e}")
-        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
\ No newline at end of file
+        return {"statusCode": 500, "body": _json_dumps({"error": str(e)})}
+    if len(result) == 1 and result["status"] in _STATUS_RESPONSES:
+        return _STATUS_RESPONSES[result["status"]]
+    return {"statusCode": 200, "body": _json_dumps(result)}
+
+def process_queue(event):
+    """
+    SQS consumer entry point for notes queued by process_webhook.
+    
+    Each record body is a JSON object with a note_id. Up to _QUEUE_WORKERS
+    records are processed at once, sharing the session, AWS clients and
+    access token, so one invocation pays for imports, connection setup and
+    token refresh once for the whole batch. The S3 connection pool is
+    split between the workers, which bounds both the connections and the
+    multipart buffers in flight; PDFium text extraction runs one record
+    at a time (see _PDFIUM_LOCK). Failed records are reported
+    individually and only those are redelivered by SQS; the event source
+    mapping needs ReportBatchItemFailures enabled.
+    
+    Args:
+        event: SQS event dictionary with a "Records" list
+        
+    Returns:
+        dict: {"batchItemFailures": [{"itemIdentifier": message_id}, ...]}
+    """
+    records = event.get("Records", [])
+    if not records:
+        return {"batchItemFailures": []}
+    from concurrent.futures import ThreadPoolExecutor
+    _load_heavy()
+
+    workers = min(_QUEUE_WORKERS, len(records))
+    upload_concurrency = max(1, min(_UPLOAD_CONCURRENCY, _S3_MAX_CONNECTIONS // workers))
+
+    def handle(record):
+        return process_note(_json_loads(record["body"])["note_id"], upload_concurrency)
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(record, pool.submit(handle, record)) for record in records]
+        for record, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error: {e}")
+                failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": failures}